@@ -0,0 +1,35 @@
+"""
+One-off backfill of name_lower for products created before it existed.
+
+Run once before deploying the name_lower search: python backfill_name_lower.py
+"""
+from pymongo import MongoClient, UpdateOne
+
+from main import MONGODB_URL, DB_NAME, normalize_name
+
+BATCH_SIZE = 1000
+
+
+def main():
+    client = MongoClient(MONGODB_URL)
+    products_collection = client[DB_NAME].products
+
+    updated = 0
+    batch = []
+    for product in products_collection.find({"name_lower": {"$exists": False}}, {"name": 1}):
+        batch.append(UpdateOne({"_id": product["_id"]}, {"$set": {"name_lower": normalize_name(product["name"])}}))
+        if len(batch) == BATCH_SIZE:
+            updated += products_collection.bulk_write(batch, ordered=False).modified_count
+            batch = []
+    if batch:
+        updated += products_collection.bulk_write(batch, ordered=False).modified_count
+
+    # Build the index here so the app's startup create_index is a no-op on large collections
+    products_collection.create_index([("name_lower", 1)])
+
+    client.close()
+    print(f"Backfilled name_lower on {updated} products")
+
+
+if __name__ == "__main__":
+    main()
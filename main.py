@@ -1,36 +1,96 @@
-from fastapi import FastAPI, HTTPException, Query, Path
-from pydantic import BaseModel, Field
+from fastapi import FastAPI, HTTPException, Query, Path, BackgroundTasks
+from fastapi.responses import ORJSONResponse, StreamingResponse
+from pydantic import BaseModel, Field, field_validator
 from typing import List, Optional
 from bson import ObjectId
+from bson.regex import Regex
 import pymongo
-from pymongo import MongoClient
+from pymongo.errors import BulkWriteError, DuplicateKeyError, ExecutionTimeout, PyMongoError
+from motor.motor_asyncio import AsyncIOMotorClient
 import os
+import asyncio
+import logging
 from datetime import datetime, timezone
 import re
+from functools import lru_cache
+from cachetools import TTLCache
+import orjson
 from dotenv import load_dotenv
-import os
 
 
 load_dotenv()
 
 
+logger = logging.getLogger(__name__)
+
+
 # Initialize FastAPI app
-app = FastAPI(title="E-commerce API", description="E-commerce Application", version="1.0.0")
+app = FastAPI(title="E-commerce API", description="E-commerce Application", version="1.0.0", default_response_class=ORJSONResponse)
 
 # Get environment variables
 MONGODB_URL = os.getenv("MONGODB_URL")
-PORT = os.getenv("PORT", 8000)  # Optional default value
+PORT = int(os.getenv("PORT", "8000"))  # Optional default value
 DB_NAME = os.getenv("DB_NAME", "ecommerce")
+MONGO_MAX_POOL = int(os.getenv("MONGO_MAX_POOL", "50"))
+MONGO_MIN_POOL = int(os.getenv("MONGO_MIN_POOL", "5"))
 
 # Verify URL exists
 if not MONGODB_URL:
     raise Exception("MONGODB_URL is missing from .env file.")
 
-# Setup MongoDB connection
-client = MongoClient(MONGODB_URL)
-db = client[DB_NAME]  # Uses DB_NAME from .env
-products_collection = db.products
-orders_collection = db.orders
+# MongoDB connection (created on startup so the client binds to the running event loop)
+client = None
+db = None
+products_collection = None
+orders_collection = None
+
+
+@app.on_event("startup")
+async def startup_db_client():
+    global client, db, products_collection, orders_collection
+    # Explicit pool sizes and short timeouts so requests fail fast instead of hanging
+    client = AsyncIOMotorClient(
+        MONGODB_URL,
+        maxPoolSize=MONGO_MAX_POOL,
+        minPoolSize=MONGO_MIN_POOL,
+        serverSelectionTimeoutMS=3000,
+        # Kept well above the largest maxTimeMS so slow queries end in ExecutionTimeout, not a dropped socket
+        socketTimeoutMS=10000,
+        connectTimeoutMS=3000,
+        waitQueueTimeoutMS=2000,
+        retryWrites=True
+    )
+    db = client[DB_NAME]  # Uses DB_NAME from .env
+    products_collection = db.products
+    orders_collection = db.orders
+
+    # Warm up the connection pool before serving requests
+    await client.admin.command("ping")
+
+    # Indexes backing the list filters and sorts (_id is indexed by default)
+    await products_collection.create_index([("name_lower", 1)])
+    await products_collection.create_index([("sizes.size", 1)])
+    await orders_collection.create_index([("userId", 1), ("_id", 1)])
+
+
+@app.on_event("shutdown")
+async def shutdown_db_client():
+    if client is not None:
+        client.close()
+
+
+# Attempts (with backoff) for the background order insert before it is logged as lost
+ORDER_INSERT_ATTEMPTS = 3
+ORDER_INSERT_BACKOFF_SECONDS = 0.5
+
+# Upper bound on orders accepted by one bulk request (bounds the $in lookup and insert_many)
+MAX_BULK_ORDERS = 100
+
+# Short-lived caches for list responses, keyed by the normalized query parameters.
+# maxsize bounds the number of entries, so only pages up to CACHE_MAX_LIMIT items are cached.
+PRODUCTS_CACHE = TTLCache(maxsize=1024, ttl=5)
+ORDERS_CACHE = TTLCache(maxsize=1024, ttl=5)
+CACHE_MAX_LIMIT = 100
 
 
 # Pydantic models for Products
@@ -58,6 +118,13 @@ class OrderItem(BaseModel):
     productId: str
     qty: int
 
+    @field_validator("productId")
+    @classmethod
+    def validate_product_id(cls, value: str) -> str:
+        if not ObjectId.is_valid(value):
+            raise ValueError(f"Invalid product ID: {value}")
+        return value
+
 class OrderCreate(BaseModel):
     userId: str
     items: List[OrderItem]
@@ -82,21 +149,181 @@ class OrderListResponse(BaseModel):
     data: List[OrderDetails]
     page: dict
 
-# Helper functions to convert MongoDB ObjectId to string
+# Helper functions to convert MongoDB ObjectId to string (hex of the raw 12 bytes, same as str(ObjectId))
 def product_helper(product) -> dict:
     return {
-        "id": str(product["_id"]),
+        "id": product["_id"].binary.hex(),
         "name": product["name"],
         "price": product["price"]
     }
 
 def order_helper(order) -> dict:
+    # Items already embed productDetails (subset pattern), so no $lookup is needed here
     return {
-        "id": str(order["_id"]),
+        "id": order["_id"].binary.hex(),
         "items": order["items"],
         "total": order["total"]
     }
 
+def normalize_name(name: str) -> str:
+    """
+    Lowercase a product name for name_lower. This is the only lowering rule: it is used
+    on create, on search and by backfill_name_lower.py, so non-ASCII names match too.
+    """
+    return name.lower()
+
+@lru_cache(maxsize=1024)
+def name_regex(name: str) -> Regex:
+    """
+    Build the anchored, escaped prefix pattern for name_lower, reused across requests.
+    Matching a lowercased field case-sensitively keeps the regex a bounded index scan,
+    which a case-insensitive ("i") regex is not.
+    """
+    return Regex("^" + re.escape(normalize_name(name)))
+
+# Time budgets for the pagination count: generous on the first page, tight on later pages
+FIRST_PAGE_COUNT_TIMEOUT_MS = 5000
+COUNT_TIMEOUT_MS = 200
+
+async def count_matching(collection, query_filter: dict, max_time_ms: int) -> Optional[int]:
+    """
+    Count documents matching the filter within the time budget, or return None if it runs out
+    """
+    try:
+        return await collection.count_documents(query_filter, maxTimeMS=max_time_ms)
+    except ExecutionTimeout:
+        return None
+
+async def fetch_page(collection, query_filter: dict, projection: dict, limit: int, offset: int, count: bool, after: Optional[ObjectId] = None):
+    """
+    Fetch one page (sorted by _id) and return (docs, next_offset, next_after, total).
+    next_after (the last _id of the page) is set whenever a next page exists;
+    next_offset is only set in offset mode. total is None when not counted (count
+    disabled, after mode, or the count ran out of time).
+    """
+    if after is not None:
+        # Keyset pagination: seek past the previous page on the _id index instead of skipping
+        query_filter = {**query_filter, "_id": {"$gt": after}}
+        offset = 0
+        count = False
+
+    # Fetch one extra document to detect whether a next page exists
+    cursor = collection.find(query_filter, projection).sort("_id", 1).skip(offset).limit(limit + 1)
+    if count:
+        # Run the time-bounded count alongside the page query; a slow count never delays
+        # or discards the page, it just leaves total unset
+        max_time_ms = FIRST_PAGE_COUNT_TIMEOUT_MS if offset == 0 else COUNT_TIMEOUT_MS
+        docs, total = await asyncio.gather(
+            cursor.to_list(length=limit + 1),
+            count_matching(collection, query_filter, max_time_ms)
+        )
+    else:
+        docs, total = await cursor.to_list(length=limit + 1), None
+
+    if len(docs) > limit:
+        next_offset = str(offset + limit) if after is None else None
+        return docs[:limit], next_offset, docs[limit - 1]["_id"].binary.hex(), total
+    return docs, None, None, total
+
+async def stream_page(collection, query_filter: dict, projection: dict, limit: int, offset: int, after: Optional[ObjectId], helper) -> StreamingResponse:
+    """
+    Stream one page (sorted by _id) as newline-delimited JSON without holding it in memory.
+    The first document is fetched before responding, so connection and query errors still
+    surface as a 500; an error after that can only cut the stream short.
+    """
+    if after is not None:
+        query_filter = {**query_filter, "_id": {"$gt": after}}
+        offset = 0
+    cursor = collection.find(query_filter, projection).sort("_id", 1).skip(offset).limit(limit)
+    try:
+        first = await cursor.next()
+    except StopAsyncIteration:
+        first = None
+
+    async def generate():
+        if first is None:
+            return
+        yield orjson.dumps(helper(first)) + b"\n"
+        async for doc in cursor:
+            yield orjson.dumps(helper(doc)) + b"\n"
+
+    return StreamingResponse(generate(), media_type="application/x-ndjson")
+
+async def build_order_docs(orders: List[OrderCreate]) -> list:
+    """
+    Validate products and build order documents, fetching all referenced products in one query
+    """
+    # Parse all product IDs up front (already validated by OrderItem)
+    ids_per_order = [[ObjectId(item.productId) for item in order.items] for order in orders]
+    
+    # Fetch every referenced product in a single query
+    all_ids = list({product_id for ids in ids_per_order for product_id in ids})
+    cursor = products_collection.find({"_id": {"$in": all_ids}}, {"name": 1, "price": 1})
+    products = {product["_id"]: product async for product in cursor}
+    
+    order_docs = []
+    for order, ids in zip(orders, ids_per_order):
+        # Validate products exist and calculate total
+        total_price = 0.0
+        order_items = []
+        
+        for item, product_id in zip(order.items, ids):
+            product = products.get(product_id)
+            if not product:
+                raise HTTPException(status_code=404, detail=f"Product not found: {item.productId}")
+            
+            # Prepare order item with product details. The product name is snapshotted
+            # into the order (subset pattern) so reads never need to join back to products.
+            order_item = {
+                "productDetails": {
+                    "name": product["name"],
+                    "id": item.productId
+                },
+                "qty": item.qty
+            }
+            order_items.append(order_item)
+            total_price += product["price"] * item.qty
+        
+        # Create order document
+        order_docs.append({
+            "userId": order.userId,
+            "items": order_items,
+            "total": total_price,
+            "createdAt": datetime.now(timezone.utc)
+        })
+    
+    return order_docs
+
+async def insert_order(order_doc: dict):
+    """
+    Insert an order into MongoDB and drop cached order pages for its user.
+    Runs after the response is sent, so failures are retried and then logged with the full document.
+    """
+    for attempt in range(1, ORDER_INSERT_ATTEMPTS + 1):
+        try:
+            await orders_collection.insert_one(order_doc)
+            break
+        except DuplicateKeyError:
+            # The _id is generated up front, so an earlier attempt already stored this order
+            break
+        except PyMongoError as e:
+            if attempt == ORDER_INSERT_ATTEMPTS:
+                logger.error(
+                    "Failed to store order %s after %d attempts: %s; order document: %s",
+                    order_doc["_id"], attempt, e, orjson.dumps(order_doc, default=str).decode()
+                )
+                return
+            logger.warning("Storing order %s failed (attempt %d): %s", order_doc["_id"], attempt, e)
+            await asyncio.sleep(ORDER_INSERT_BACKOFF_SECONDS * attempt)
+    invalidate_user_orders(order_doc["userId"])
+
+def invalidate_user_orders(user_id: str):
+    """
+    Drop cached order pages for a user
+    """
+    for key in [key for key in list(ORDERS_CACHE) if key[0] == user_id]:
+        ORDERS_CACHE.pop(key, None)
+
 # Root endpoint
 @app.get("/")
 async def root():
@@ -111,10 +338,16 @@ async def create_product(product: ProductCreate):
     """
     try:
         # Convert pydantic model to dict
-        product_dict = product.model_dump()
+        product_dict = product.model_dump(exclude_unset=True)
+        
+        # Lowercased copy of the name for index-backed, case-insensitive prefix search
+        product_dict["name_lower"] = normalize_name(product_dict["name"])
         
         # Insert product into MongoDB
-        result = products_collection.insert_one(product_dict)
+        result = await products_collection.insert_one(product_dict)
+        
+        # Any cached product page may now be stale
+        PRODUCTS_CACHE.clear()
         
         # Return the created product ID
         return {"id": str(result.inserted_id)}
@@ -122,157 +355,210 @@ async def create_product(product: ProductCreate):
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
-@app.get("/products", status_code=200)
+@app.get("/products", status_code=200, response_model=None)
 async def list_products(
-    name: Optional[str] = Query(None, description="Product name for partial/regex search"),
+    name: Optional[str] = Query(None, description="Product name prefix search (case-insensitive)"),
     size: Optional[str] = Query(None, description="Filter by size"),
     limit: int = Query(10, ge=1, description="Number of documents to return"),
-    offset: int = Query(0, ge=0, description="Number of documents to skip")
+    offset: int = Query(0, ge=0, description="Number of documents to skip"),
+    count: bool = Query(True, description="Include the total number of matching documents in page.total (best effort, time-bounded); disable to skip the count"),
+    after: Optional[str] = Query(None, description="Return documents after this ID (preferred over offset; pass the previous page's nextAfter value). The count is not applied in this mode"),
+    stream: bool = Query(False, description="Stream documents as newline-delimited JSON, without count or page info")
 ):
     """
     List products with optional filtering and pagination
     """
+    cache_key = (name, size, limit, offset, count, after)
+    cacheable = not stream and limit <= CACHE_MAX_LIMIT
+    cached = PRODUCTS_CACHE.get(cache_key) if cacheable else None
+    if cached is not None:
+        return ORJSONResponse(content=cached)
+    
     try:
+        # Parse the keyset cursor
+        if after and not ObjectId.is_valid(after):
+            raise HTTPException(status_code=400, detail=f"Invalid cursor: {after}")
+        after_id = ObjectId(after) if after else None
+        
         # Build query filter
         query_filter = {}
         
-        # Name filter (partial/regex search)
+        # Name filter (anchored prefix search on the lowercased name, bounded by its index)
         if name:
-            query_filter["name"] = {"$regex": name, "$options": "i"}
+            query_filter["name_lower"] = name_regex(name)
         
         # Size filter
         if size:
             query_filter["sizes.size"] = size
         
-        # Get total count for pagination
-        total_count = products_collection.count_documents(query_filter)
+        # Stream mode skips the count, pagination info and cache
+        if stream:
+            return await stream_page(products_collection, query_filter, {"name": 1, "price": 1}, limit, offset, after_id, product_helper)
         
-        # Execute query with pagination
-        cursor = products_collection.find(query_filter).sort("_id", 1).skip(offset).limit(limit)
-        products = list(cursor)
+        # Fetch the page, projecting only the fields in the response
+        products, next_offset, next_after, total = await fetch_page(products_collection, query_filter, {"name": 1, "price": 1}, limit, offset, count, after_id)
         
         # Convert products to response format
         product_list = [product_helper(product) for product in products]
         
         # Calculate pagination info
-        next_offset = offset + limit if offset + limit < total_count else None
-        prev_offset = max(0, offset - limit) if offset > 0 else None
+        prev_offset = max(0, offset - limit) if offset > 0 and after_id is None else None
         
         # Build pagination object
         pagination = {
-            "next": str(next_offset) if next_offset is not None else None,
+            "next": next_offset,
+            "nextAfter": next_after,
             "limit": limit,
+            "total": total,
             "previous": str(prev_offset) if prev_offset is not None else None
         }
         
-        return {
+        response = {
             "data": product_list,
             "page": pagination
         }
+        if cacheable:
+            PRODUCTS_CACHE[cache_key] = response
+        # Return the response directly so rows are not re-encoded by FastAPI
+        return ORJSONResponse(content=response)
     
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
 #* ==================== ORDERS API ====================
 
 @app.post("/orders", status_code=201)
-async def create_order(order: OrderCreate):
+async def create_order(order: OrderCreate, background_tasks: BackgroundTasks):
     """
     Create a new order
     """
     try:
-        # Validate products exist and calculate total
-        total_price = 0.0
-        order_items = []
+        # Validate products and build the order document (must 404 before responding)
+        order_doc = (await build_order_docs([order]))[0]
         
-        for item in order.items:
-            # Find product by ID
-            try:
-                product_id = ObjectId(item.productId)
-            except:
-                raise HTTPException(status_code=400, detail=f"Invalid product ID: {item.productId}")
-                
-            product = products_collection.find_one({"_id": product_id})
-            if not product:
-                raise HTTPException(status_code=404, detail=f"Product not found: {item.productId}")
-            
-            # Calculate item total
-            item_total = product["price"] * item.qty
-            total_price += item_total
-            
-            # Prepare order item with product details
-            order_item = {
-                "productDetails": {
-                    "name": product["name"],
-                    "id": item.productId
-                },
-                "qty": item.qty
-            }
-            order_items.append(order_item)
+        # Generate the ID up front so the write can happen after the response is sent
+        order_doc["_id"] = ObjectId()
+        background_tasks.add_task(insert_order, order_doc)
         
-        # Create order document
-        order_doc = {
-            "userId": order.userId,
-            "items": order_items,
-            "total": total_price,
-            "createdAt": datetime.now(timezone.utc)
-        }
+        # Return the created order ID
+        return {"id": str(order_doc["_id"])}
+    
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+@app.post("/orders/bulk", status_code=201)
+async def create_orders_bulk(orders: List[OrderCreate]):
+    """
+    Create multiple orders in a single write.
+    Returns the IDs of the inserted orders and, on partial failure (207), the errors by index.
+    """
+    try:
+        if len(orders) > MAX_BULK_ORDERS:
+            raise HTTPException(status_code=400, detail=f"At most {MAX_BULK_ORDERS} orders can be created per request")
         
-        # Insert order into MongoDB
-        result = orders_collection.insert_one(order_doc)
+        # Validate products for every order with one lookup
+        order_docs = await build_order_docs(orders)
+        if not order_docs:
+            return {"ids": [], "errors": []}
         
-        # Return the created order ID
-        return {"id": str(result.inserted_id)}
+        # Insert all orders in one round-trip; unordered so the server can apply them independently
+        try:
+            await orders_collection.insert_many(order_docs, ordered=False)
+            write_errors = []
+        except BulkWriteError as e:
+            # Some orders may still have been written, so report them instead of failing the whole request
+            write_errors = e.details.get("writeErrors", [])
+        finally:
+            # Drop cached order pages for every affected user
+            for user_id in {order.userId for order in orders}:
+                invalidate_user_orders(user_id)
+        
+        # insert_many assigns _id to every document up front; failed ones are listed by index
+        failed = {error["index"] for error in write_errors}
+        response = {
+            "ids": [str(doc["_id"]) for index, doc in enumerate(order_docs) if index not in failed],
+            "errors": [
+                {"index": error["index"], "code": error.get("code"), "message": error.get("errmsg")}
+                for error in write_errors
+            ]
+        }
+        if write_errors:
+            return ORJSONResponse(status_code=207, content=response)
+        return response
     
     except HTTPException:
         raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
-@app.get("/orders/{user_id}", status_code=200)
+@app.get("/orders/{user_id}", status_code=200, response_model=None)
 async def get_user_orders(
     user_id: str = Path(..., description="User ID"),
     limit: int = Query(10, ge=1, description="Number of documents to return"),
-    offset: int = Query(0, ge=0, description="Number of documents to skip")
+    offset: int = Query(0, ge=0, description="Number of documents to skip"),
+    count: bool = Query(True, description="Include the total number of matching documents in page.total (best effort, time-bounded); disable to skip the count"),
+    after: Optional[str] = Query(None, description="Return documents after this ID (preferred over offset; pass the previous page's nextAfter value). The count is not applied in this mode"),
+    stream: bool = Query(False, description="Stream documents as newline-delimited JSON, without count or page info")
 ):
     """
     Get list of orders for a specific user
     """
+    cache_key = (user_id, limit, offset, count, after)
+    cacheable = not stream and limit <= CACHE_MAX_LIMIT
+    cached = ORDERS_CACHE.get(cache_key) if cacheable else None
+    if cached is not None:
+        return ORJSONResponse(content=cached)
+    
     try:
+        # Parse the keyset cursor
+        if after and not ObjectId.is_valid(after):
+            raise HTTPException(status_code=400, detail=f"Invalid cursor: {after}")
+        after_id = ObjectId(after) if after else None
+        
         # Build query filter for user
         query_filter = {"userId": user_id}
         
-        # Get total count for pagination
-        total_count = orders_collection.count_documents(query_filter)
+        # Stream mode skips the count, pagination info and cache
+        if stream:
+            return await stream_page(orders_collection, query_filter, {"items": 1, "total": 1}, limit, offset, after_id, order_helper)
         
-        # Execute query with pagination (sorted by _id)
-        cursor = orders_collection.find(query_filter).sort("_id", 1).skip(offset).limit(limit)
-        orders = list(cursor)
+        # Fetch the page, projecting only the fields in the response
+        orders, next_offset, next_after, total = await fetch_page(orders_collection, query_filter, {"items": 1, "total": 1}, limit, offset, count, after_id)
         
         # Convert orders to response format
         order_list = [order_helper(order) for order in orders]
         
         # Calculate pagination info
-        next_offset = offset + limit if offset + limit < total_count else None
-        prev_offset = max(0, offset - limit) if offset > 0 else None
+        prev_offset = max(0, offset - limit) if offset > 0 and after_id is None else None
 
         # Build pagination object
         pagination = {
-            "next": str(next_offset) if next_offset is not None else None,
+            "next": next_offset,
+            "nextAfter": next_after,
             "limit": limit,
+            "total": total,
             "previous": str(prev_offset) if prev_offset is not None else None
         }
         
-        return {
+        response = {
             "data": order_list,
             "page": pagination
         }
+        if cacheable:
+            ORDERS_CACHE[cache_key] = response
+        # Return the response directly so rows are not re-encoded by FastAPI
+        return ORJSONResponse(content=response)
     
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
 # Run the application
 if __name__ == "__main__":
     import uvicorn
-    port = int(os.getenv("PORT", 8000))
-    uvicorn.run(app, host="0.0.0.0", port=port)
\ No newline at end of file
+    uvicorn.run(app, host="0.0.0.0", port=PORT)
\ No newline at end of file